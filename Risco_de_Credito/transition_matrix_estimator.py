@@ -19,16 +19,86 @@ from __future__ import annotations
 from collections import defaultdict
 from typing import Dict, List, Tuple
 import logging
+import warnings
 import numpy as np
 import pandas as pd
 import matplotlib.pyplot as plt
 import seaborn as sns
 
+try:
+    from numba import njit
+    _HAS_NUMBA = True
+except ImportError:  # numba is optional; fall back to plain Python
+    _HAS_NUMBA = False
+
+    def njit(*args, **kwargs):
+        return lambda func: func
+
 logger = logging.getLogger("creditlab.tm")
 logger.setLevel(logging.INFO)
 
 __all__ = ["TransitionMatrixLearner"]
 
+_NO_CODES = np.zeros(0, dtype=np.int64)
+
+
+@njit(cache=True)
+def _count_cube_njit(i, j, codes, n_groups, n):
+    """Count transitions into a (n_groups, n, n) int64 cube in a single loop.
+
+    With ``n_groups == 1`` every row goes to the only group and ``codes`` is
+    not read, so callers without groups can pass an empty array.
+    """
+    nn = n * n
+    cube = np.zeros(n_groups * nn, dtype=np.int64)
+    if n_groups == 1:
+        for k in range(i.shape[0]):
+            cube[i[k] * n + j[k]] += 1
+    else:
+        for k in range(i.shape[0]):
+            cube[codes[k] * nn + i[k] * n + j[k]] += 1
+    return cube.reshape((n_groups, n, n))
+
+
+@njit(cache=True)
+def _auto_rebin_njit(mat, buckets, min_count):
+    """Merge rows/cols with fewer than ``min_count`` transitions into the
+    nearest well-populated bucket, in place.
+
+    Returns ``(target, moved)``: for every bucket ``i`` that was merged,
+    ``target[i]`` is the receiving bucket and ``moved[i]`` the number of
+    transitions moved; ``target[i] == -1`` otherwise.
+    """
+    n = mat.shape[0]
+    row_sums = mat.sum(axis=1)
+    non_empty = row_sums >= min_count
+    target = np.full(n, -1, dtype=np.int64)
+    moved = np.zeros(n)
+    for i in range(n):
+        s = row_sums[i]
+        if s >= min_count:
+            continue
+        # nearest non-empty bucket; the window only narrows the candidates
+        # when one of them is inside it, and the nearest one always is then
+        j = -1
+        best = np.inf
+        for x in range(n):
+            if non_empty[x] and abs(buckets[x] - buckets[i]) < best:
+                best = abs(buckets[x] - buckets[i])
+                j = x
+        if j < 0:
+            continue
+        for k in range(n):
+            mat[j, k] += mat[i, k]
+        for k in range(n):
+            mat[k, j] += mat[k, i]
+        for k in range(n):
+            mat[i, k] = 0
+            mat[k, i] = 0
+        target[i] = j
+        moved[i] = s
+    return target, moved
+
 
 class TransitionMatrixLearner:
     """Learn transition matrices and provide quick seaborn visualisation."""
@@ -43,6 +113,18 @@ class TransitionMatrixLearner:
         min_count: int = 10,
         rebin_window: int = 7,
     ):
+        """
+        ``rebin_window`` is accepted for backwards compatibility but has no
+        effect: auto_rebin always merges a sparse bucket into the nearest
+        well-populated one, which the window never changed.
+        """
+        if rebin_window != 7:
+            warnings.warn(
+                "rebin_window has no effect and will be removed; auto_rebin always "
+                "merges into the nearest well-populated bucket",
+                DeprecationWarning,
+                stacklevel=2,
+            )
         if auto_rebin and drop_empty:
             raise ValueError("Only one of auto_rebin or drop_empty can be True")
         self.buckets = sorted(buckets)
@@ -52,10 +134,16 @@ class TransitionMatrixLearner:
         self.min_count = int(min_count)
         self.rebin_window = int(rebin_window)
         self.n = len(self.buckets)
+        self._edges = np.asarray(self.buckets, dtype=float)
+        self._inner_edges = self._edges[1:]
         self.cleaned_buckets: List[int] = self.buckets.copy()
         self._mat_global: np.ndarray | None = None
         self._mat_by_gh: Dict[str, np.ndarray] = {}
         self._mat_by_stage: Dict[int, np.ndarray] = {}
+        # buckets kept by each matrix (differ from self.buckets only with drop_empty)
+        self._buckets_by_gh: Dict[str, List[int]] = {}
+        self._buckets_by_stage: Dict[int, List[int]] = {}
+        self._prep_cache: Dict[Tuple[int, float], Tuple[np.ndarray, np.ndarray]] = {}
         self.logger = logger.getChild(self.__class__.__name__)
 
     # ------------------------------------------------------------------
@@ -68,80 +156,143 @@ class TransitionMatrixLearner:
         bucket_col: str,
         group_col: str | None = None,
     ) -> "TransitionMatrixLearner":
-        """Count transitions (t -> t+1 month) per modality and normalise."""
-        panel = panel[[id_col, time_col, bucket_col] + ([group_col] if group_col else [])].copy()
-        panel[time_col] = pd.to_datetime(panel[time_col])
-        panel = panel.sort_values([id_col, time_col])
-
-        # create shifted df to align t and t+1
-        shifted = panel.copy()
-        shifted[time_col] += pd.DateOffset(months=1)
-        merged = panel.merge(
-            shifted,
-            on=[id_col, time_col],
-            suffixes=("_t", "_t1"),
-            how="inner",
-        )
+        """Count transitions (t -> t+1 month) per modality and normalise.
 
-        # global matrix
-        counts_global = self._count_matrix(
-            merged[bucket_col + "_t"], merged[bucket_col + "_t1"]
-        )
-        self._mat_global = self._clean_matrix(counts_global)
+        Matrix rows are the bucket at t and columns the bucket at t+1; a
+        transition belongs to the GH observed at t. Each row is paired only
+        with the next row of the same contract, and the pair counts when that
+        row is exactly one month later and both buckets are present (rows
+        with a missing bucket never form a transition).
 
-        # by GH
+        The panel must therefore hold one row per contract per month: extra
+        rows in a month (or duplicated ``(id, time)`` pairs) hide transitions.
+        fit() logs a warning when it finds such rows.
+        """
+        cols = [id_col, time_col, bucket_col] + ([group_col] if group_col else [])
+        # assign() returns a new frame, so the caller's panel is never mutated
+        panel = panel.loc[:, cols].assign(**{time_col: lambda df: pd.to_datetime(df[time_col])})
+        # sort on integer contract codes rather than raw (often string) ids;
+        # lexsort is stable, so panels already ordered by contract stay cheap
+        id_codes, _ = pd.factorize(panel[id_col])
+        # datetime64 wall-clock keys: a tz-aware column would come out of
+        # to_numpy() as an object array of Timestamps
+        times = panel[time_col]
+        if times.dt.tz is not None:
+            times = times.dt.tz_localize(None)
+        t_key = times.to_numpy()
+        order = np.lexsort((t_key, id_codes))
+        panel = panel.take(order)
+        id_codes = id_codes[order]
+        t_key = t_key[order]
+
+        # align t and t+1: the panel is sorted by contract, so a plain
+        # positional shift plus a same-contract mask replaces any join/groupby
+        same_contract = np.zeros(len(panel), dtype=bool)
+        same_contract[:-1] = id_codes[1:] == id_codes[:-1]
+        same_contract &= id_codes >= 0  # rows without a contract id never form a transition
+        next_bucket = panel[bucket_col].shift(-1)
+        next_time = panel[time_col].shift(-1)
+        months = t_key.astype("datetime64[M]")
+        n_same_month = int((same_contract[:-1] & (months[1:] == months[:-1])).sum())
+        if n_same_month:
+            self.logger.warning(
+                "[TM] %d rows share a month with the next row of the same contract; "
+                "expected one row per contract per month, some transitions are lost",
+                n_same_month,
+            )
+        # rows with a missing bucket on either side are not transitions
+        keep = same_contract & (
+            panel[bucket_col].notna()
+            & next_bucket.notna()
+            & (next_time == panel[time_col] + pd.DateOffset(months=1))
+        ).to_numpy()
+
+        # bucket indices are computed once and shared by every view below;
+        # only positional arrays are kept, no sub-frame is built
+        i_all = self._bucket_index(panel[bucket_col].to_numpy()[keep])
+        j_all = self._bucket_index(next_bucket.to_numpy()[keep])
+
+        # one pass over the data: counts per (GH, current bucket, next bucket);
+        # missing GHs go to an extra trailing slot so they still count globally
         if group_col:
-            for gh, grp in merged.groupby(group_col + "_t"):
-                counts = self._count_matrix(
-                    grp[bucket_col + "_t"], grp[bucket_col + "_t1"]
-                )
-                self._mat_by_gh[gh] = self._clean_matrix(counts)
+            codes, gh_levels = pd.factorize(panel[group_col].to_numpy()[keep], sort=True)
+            codes = np.where(codes < 0, len(gh_levels), codes)
+        else:
+            codes, gh_levels = None, []
+        cube = self._count_matrix(i_all, j_all, codes, len(gh_levels) + 1)
 
-        # by stage (current bucket)
-        for idx, grp in merged.groupby(bucket_col + "_t"):
-            counts = self._count_matrix(
-                grp[bucket_col + "_t"], grp[bucket_col + "_t1"]
-            )
-            self._mat_by_stage[int(idx)] = self._clean_matrix(counts)
+        # global matrix
+        counts_global = cube.sum(axis=0)
+        mat_global, kept = self._clean_matrix(counts_global.copy())  # auto_rebin edits in place
+
+        # by GH
+        mat_by_gh: Dict[str, np.ndarray] = {}
+        buckets_by_gh: Dict[str, List[int]] = {}
+        for k, gh in enumerate(gh_levels):
+            mat_by_gh[gh], buckets_by_gh[gh] = self._clean_matrix(cube[k])
+
+        # by stage (current bucket): the global row b alone
+        mat_by_stage: Dict[int, np.ndarray] = {}
+        buckets_by_stage: Dict[int, List[int]] = {}
+        for b in np.flatnonzero(counts_global.sum(axis=1)):
+            counts = np.zeros_like(counts_global)
+            counts[b] = counts_global[b]
+            stage = int(self.buckets[b])
+            mat_by_stage[stage], buckets_by_stage[stage] = self._clean_matrix(counts)
+
+        # swap results in only once everything succeeded, so a failing fit()
+        # leaves the previous state untouched
+        self._mat_global, self.cleaned_buckets = mat_global, list(kept)
+        self._mat_by_gh, self._buckets_by_gh = mat_by_gh, buckets_by_gh
+        self._mat_by_stage, self._buckets_by_stage = mat_by_stage, buckets_by_stage
+        self._prep_cache.clear()
         return self
 
     # ------------------------------------------------------------------
-    def _count_matrix(self, col_from: pd.Series, col_to: pd.Series) -> np.ndarray:
-        mat = np.zeros((self.n, self.n), dtype=float)
-        for src, dst in zip(col_from, col_to):
-            i = np.searchsorted(self.buckets, src, side="right") - 1
-            j = np.searchsorted(self.buckets, dst, side="right") - 1
-            mat[i, j] += 1
-        return mat
+    def _bucket_index(self, values: np.ndarray) -> np.ndarray:
+        """Map an ndarray of raw values to bucket positions in ``[0, n)``."""
+        # binning on the interior edges sends values below the first edge to
+        # bucket 0 and values above the last one to bucket n-1, no clip needed
+        return np.digitize(values, self._inner_edges, right=False)
+
+    # ------------------------------------------------------------------
+    def _count_matrix(
+        self,
+        i: np.ndarray,
+        j: np.ndarray,
+        codes: np.ndarray | None = None,
+        n_groups: int = 1,
+    ) -> np.ndarray:
+        """Return a (n_groups, n, n) int64 cube of transition counts."""
+        if _HAS_NUMBA:
+            return _count_cube_njit(i, j, _NO_CODES if codes is None else codes, n_groups, self.n)
+        flat = i * self.n + j
+        if codes is not None:
+            flat += codes * (self.n * self.n)
+        cube = np.bincount(flat, minlength=n_groups * self.n * self.n)
+        return cube.reshape(n_groups, self.n, self.n).astype(np.int64, copy=False)
 
     # ------------------------------------------------------------------
-    def _clean_matrix(self, mat: np.ndarray) -> np.ndarray:
+    def _clean_matrix(self, mat: np.ndarray) -> Tuple[np.ndarray, List[int]]:
+        """Turn an integer count matrix into a float32 row-stochastic matrix.
+
+        Returns the matrix together with the buckets it covers; the list is
+        ``self.buckets`` itself unless ``drop_empty`` removed some of them.
+        """
         row_sums = mat.sum(axis=1)
+        kept = self.buckets
 
         if self.auto_rebin:
-            non_empty = [i for i, s in enumerate(row_sums) if s >= self.min_count]
-            for i, s in enumerate(row_sums):
-                if s < self.min_count:
-                    if not non_empty:
-                        continue
-                    candidates = [x for x in non_empty if abs(self.buckets[x] - self.buckets[i]) <= self.rebin_window]
-                    if not candidates:
-                        candidates = non_empty
-                    j = min(candidates, key=lambda x: abs(self.buckets[x] - self.buckets[i]))
-                    mat[j] += mat[i]
-                    mat[:, j] += mat[:, i]
-                    mat[i] = 0
-                    mat[:, i] = 0
-                    row_sums[j] += s
-                    row_sums[i] = 0
-                    self.logger.info(
-                        "[TM] Empty bucket %d -> re-binned into %d (%d transitions moved)",
-                        self.buckets[i],
-                        self.buckets[j],
-                        int(s),
-                    )
-            # buckets unchanged
-            self.cleaned_buckets = self.buckets.copy()
+            target, moved = _auto_rebin_njit(
+                mat, self._edges, self.min_count
+            )
+            for i in np.flatnonzero(target >= 0):
+                self.logger.info(
+                    "[TM] Empty bucket %d -> re-binned into %d (%d transitions moved)",
+                    self.buckets[i],
+                    self.buckets[target[i]],
+                    int(moved[i]),
+                )
 
         elif self.drop_empty:
             keep = [s >= self.min_count for s in row_sums]
@@ -153,20 +304,18 @@ class TransitionMatrixLearner:
                         int(s),
                     )
             mat = mat[np.ix_(keep, keep)]
-            self.cleaned_buckets = [b for b, k in zip(self.buckets, keep) if k]
-        else:
-            self.cleaned_buckets = self.buckets.copy()
+            kept = [b for b, k in zip(self.buckets, keep) if k]
 
         # apply Laplace only to non-empty rows
-        final = np.zeros_like(mat, dtype=float)
-        for i in range(mat.shape[0]):
-            if mat[i].sum() > 0:
-                row = mat[i] + self.alpha
-                final[i] = row / row.sum()
-        return final
+        non_empty = mat.sum(axis=1, keepdims=True) > 0
+        smoothed = np.where(non_empty, mat + self.alpha, 0.0)
+        totals = smoothed.sum(axis=1, keepdims=True)
+        final = np.divide(smoothed, totals, out=np.zeros_like(smoothed), where=totals > 0)
+        return final.astype(np.float32), kept
 
     # ------------------------------------------------------------------
     def get_matrix(self, *, gh: str | None = None, stage: int | None = None) -> np.ndarray:
+        """Return the fitted float32 transition matrix (global, per GH or per stage)."""
         if gh is None and stage is None:
             if self._mat_global is None:
                 raise RuntimeError("fit() not called yet")
@@ -197,26 +346,34 @@ class TransitionMatrixLearner:
 
         figs: List[plt.Figure] = []
         cmap = sns.color_palette("Blues", as_cmap=True)
-        xt = yt = [str(b) for b in self.cleaned_buckets]
 
-        def _prep(mat: np.ndarray, thr: float = 0.5) -> pd.DataFrame:
+        def _prep(mat: np.ndarray, thr: float = 0.5) -> Tuple[np.ndarray, np.ndarray]:
             """
             Converte a matriz em percentuais e substitui por NaN
             todos os valores abaixo do limiar 'thr' (em pontos-percentuais).
+            Devolve também a máscara das células NaN.
+            Resultado guardado em cache por (matriz, thr) até o próximo fit();
+            uma matriz de get_matrix() alterada in-place continua com a imagem
+            antiga em cache até lá.
             """
-            perc = mat * 100
-            perc[perc < thr] = np.nan        # “apaga” zeros (e ≈0) para não aparecerem
-            return pd.DataFrame(perc, index=yt, columns=xt)
-
-
-        # 1. Global
-        if "global" in modes:
-            df = _prep(self._mat_global)
-            mask = df.isna()
+            key = (id(mat), thr)
+            cached = self._prep_cache.get(key)
+            if cached is None:
+                perc = mat * 100
+                perc[perc < thr] = np.nan        # “apaga” zeros (e ≈0) para não aparecerem
+                cached = self._prep_cache[key] = (perc, np.isnan(perc))
+            return cached
+
+        def _draw(mat: np.ndarray, buckets: List[int], title: str, xlabel: str, ylabel: str) -> None:
+            if not mat.size:
+                self.logger.info("[TM] Skipped heatmap '%s' (drop_empty removed every bucket)", title)
+                return
+            xt = yt = [str(b) for b in buckets]
+            perc, mask = _prep(mat)
             fig, ax = plt.subplots(figsize=(6, 5))
             sns.heatmap(
-                df,
-                mask=df.isna(),   # células < thr ficam brancas
+                perc,
+                mask=mask,   # células < thr ficam brancas
                 annot=True,
                 fmt=".0f",
                 cmap=cmap,
@@ -224,52 +381,30 @@ class TransitionMatrixLearner:
                 xticklabels=xt,
                 yticklabels=yt,
             )
-            ax.set_title("Matriz de Transição Global (%)")
-            ax.set_xlabel("Bucket Atraso - Próxima Safra")
-            ax.set_ylabel("Bucket Atraso - Safra Atual")
+            ax.set_title(title)
+            ax.set_xlabel(xlabel)
+            ax.set_ylabel(ylabel)
             figs.append(fig)
 
+        # 1. Global
+        if "global" in modes:
+            _draw(
+                self._mat_global,
+                self.cleaned_buckets,
+                "Matriz de Transição Global (%)",
+                "Bucket Atraso - Próxima Safra",
+                "Bucket Atraso - Safra Atual",
+            )
+
         # 2. Grupo homogêneo
         if "grupo_homogeneo" in modes:
             for gh, mat in self._mat_by_gh.items():
-                df = _prep(mat)
-                mask = df.isna()
-                fig, ax = plt.subplots(figsize=(6, 5))
-                sns.heatmap(
-                    df,
-                    mask=df.isna(),   # células < thr ficam brancas
-                    annot=True,
-                    fmt=".0f",
-                    cmap=cmap,
-                    ax=ax,
-                    xticklabels=xt,
-                    yticklabels=yt,
-                )
-                ax.set_title(f"Transition Matrix – {gh} (%)")
-                ax.set_xlabel("Next bucket")
-                ax.set_ylabel("Current bucket")
-                figs.append(fig)
+                _draw(mat, self._buckets_by_gh[gh], f"Transition Matrix – {gh} (%)", "Next bucket", "Current bucket")
 
         # 3. Stage atual
         if "stage" in modes:
             for stage, mat in self._mat_by_stage.items():
-                df = _prep(mat)
-                mask = df.isna()
-                fig, ax = plt.subplots(figsize=(6, 5))
-                sns.heatmap(
-                    df,
-                    mask=df.isna(),   # células < thr ficam brancas
-                    annot=True,
-                    fmt=".0f",
-                    cmap=cmap,
-                    ax=ax,
-                    xticklabels=xt,
-                    yticklabels=yt,
-                )
-                ax.set_title(f"Transition Matrix – current bucket {stage} (%)")
-                ax.set_xlabel("Next bucket")
-                ax.set_ylabel("Current bucket")
-                figs.append(fig)
+                _draw(mat, self._buckets_by_stage[stage], f"Transition Matrix – current bucket {stage} (%)", "Next bucket", "Current bucket")
 
         return figs
 